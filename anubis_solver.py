@@ -1,29 +1,74 @@
+import asyncio
 import json
+import os
 import re
 import hashlib
-import urllib.request
+import itertools
+import multiprocessing
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from urllib.parse import urlparse
-from http.cookiejar import CookieJar
-from typing import Optional, Tuple
+from typing import Dict, List, Optional, Tuple, Union
+
+import aiohttp
 
 # Public API of this module
 __all__ = (
     "is_anubis_page",
     "extract_challenge_from_html",
     "solve_anubis_pow",
-    "solve_anubis_challenge_sync",
+    "solve_anubis_challenge",
+    "anubis_cookies",
+)
+
+# Simple heuristic markers used by Anubis challenge pages, rarest first so
+# that ordinary pages are usually rejected after a single scan
+ANUBIS_MARKERS = ("Anubis", "Making sure you", "bot")
+_ANUBIS_MARKERS_BYTES = tuple(marker.encode() for marker in ANUBIS_MARKERS)
+
+# JSON payload embedded in Anubis challenge pages
+_CHALLENGE_RE = re.compile(
+    r'<script id="anubis_challenge" type="application/json">([^<]+)</script>'
 )
+_CHALLENGE_RE_BYTES = re.compile(_CHALLENGE_RE.pattern.encode())
+
+# Decimal nonce suffixes for the PoW search. Block 0 holds 0..999 as-is;
+# every later block is "<block>" followed by a zero-padded 000..999.
+_NONCE_BLOCK = 1000
+_FIRST_NONCE_BLOCK_SUFFIXES = tuple(b"%d" % n for n in range(_NONCE_BLOCK))
+_NONCE_BLOCK_SUFFIXES = tuple(b"%03d" % n for n in range(_NONCE_BLOCK))
+
+# Recently solved challenges, most recently used last. Anubis often reissues
+# the same challenge, and the solver is deterministic, so solutions are reused.
+_POW_CACHE_SIZE = 256
+_POW_SOLUTIONS: "OrderedDict[Tuple[str, int], Tuple[int, str]]" = OrderedDict()
+
+# Anubis auth cookies by host, most recently used last, for callers to seed
+# the cookie jars of new sessions with (see anubis_cookies)
+_AUTH_COOKIES_SIZE = 256
+_AUTH_COOKIES: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
 
-# Simple heuristic markers used by Anubis challenge pages
-ANUBIS_MARKERS = ("Making sure you", "bot", "Anubis")
+# Worker processes for the CPU-bound PoW search, created on first use. Each
+# search round hands every worker a stripe of _POW_BLOCKS_PER_WORKER nonce
+# blocks (about 10 ms of hashing). Only the CPUs this process may run on
+# count (not the whole host's), capped since each worker is a full process.
+_POW_MAX_WORKERS = 8
+if hasattr(os, "sched_getaffinity"):
+    _POW_WORKERS = min(len(os.sched_getaffinity(0)), _POW_MAX_WORKERS)
+else:
+    _POW_WORKERS = min(os.cpu_count() or 1, _POW_MAX_WORKERS)
+_POW_BLOCKS_PER_WORKER = 16
+_POW_PROCESS_POOL: Optional[ProcessPoolExecutor] = None
 
 
-def is_anubis_page(html: str) -> bool:
-    """Return True if the HTML looks like an Anubis challenge page."""
+def is_anubis_page(html: Union[str, bytes]) -> bool:
+    """Return True if the HTML (str or bytes) looks like an Anubis challenge page."""
     if not html:
         return False
-    return all(marker in html for marker in ANUBIS_MARKERS)
+    markers = _ANUBIS_MARKERS_BYTES if isinstance(html, bytes) else ANUBIS_MARKERS
+    return all(marker in html for marker in markers)
 
 
 
@@ -32,26 +77,196 @@ def solve_anubis_pow(challenge: str, difficulty: int = 4) -> Tuple[int, str]:
 
     Returns a tuple of (nonce, hash_hex) that satisfies the difficulty.
     """
-    nonce = 0
-    target_prefix = "0" * difficulty
+    return _search_pow(challenge, difficulty)
 
-    while True:
-        hash_input = f"{challenge}{nonce}"
-        hash_result = hashlib.sha256(hash_input.encode()).hexdigest()
-        if hash_result.startswith(target_prefix):
-            return nonce, hash_result
-        nonce += 1
 
+def _search_pow(
+    challenge: str,
+    difficulty: int,
+    first_block: int = 0,
+    block_step: int = 1,
+    block_count: Optional[int] = None,
+) -> Optional[Tuple[int, str]]:
+    """Scan nonce blocks first_block, first_block + block_step, ... in order.
 
-def extract_challenge_from_html(html: str) -> Tuple[Optional[str], Optional[int]]:
-    """Extract challenge data from Anubis HTML.
+    Returns the first (nonce, hash_hex) found, or None if `block_count`
+    blocks were scanned without a solution.
+    """
+    # "difficulty" counts leading zero hex digits of the 64-digit hash, i.e.
+    # the digest must not exceed 16 ** (64 - difficulty) - 1. Comparing the
+    # raw digest with that bound as 32 big-endian bytes checks every digit in
+    # one bytes comparison.
+    zero_digits = min(max(difficulty, 0), 64)
+    target = (16 ** (64 - zero_digits) - 1).to_bytes(32, "big")
 
-    Returns (challenge, difficulty) if found, otherwise (None, None).
+    # Only the nonce suffix changes between attempts: hash the challenge once
+    # and clone that midstate instead of re-hashing the whole input each time.
+    prefix = hashlib.sha256()
+    prefix.update(challenge.encode())
+
+    # Nonces are searched in blocks of consecutive values that share their
+    # leading decimal digits. The hasher state after those digits is cached
+    # once per block, so each attempt only feeds a precomputed digit suffix.
+    blocks = itertools.count(first_block, block_step)
+    if block_count is not None:
+        blocks = itertools.islice(blocks, block_count)
+
+    for block in blocks:
+        if block:
+            state = prefix.copy()
+            state.update(b"%d" % block)
+            suffixes = _NONCE_BLOCK_SUFFIXES
+        else:
+            state = prefix
+            suffixes = _FIRST_NONCE_BLOCK_SUFFIXES
+
+        clone = state.copy
+        for offset, suffix in enumerate(suffixes):
+            h = clone()
+            h.update(suffix)
+            digest = h.digest()
+            if digest <= target:
+                return block * _NONCE_BLOCK + offset, digest.hex()
+    return None
+
+
+def _submit_pow_round(
+    pool: ProcessPoolExecutor, challenge: str, difficulty: int, round_start: int
+) -> List[Future]:
+    """Start one round of the parallel PoW search on every worker process.
+
+    The nonce space is scanned in rounds of consecutive blocks. Within a round
+    worker i takes blocks i, i + N, ... so the smallest nonce found across the
+    round is the same one solve_anubis_pow would return.
     """
-    script_match = re.search(
-        r'<script id="anubis_challenge" type="application/json">([^<]+)</script>',
-        html,
+    return [
+        pool.submit(
+            _search_pow,
+            challenge,
+            difficulty,
+            round_start + worker,
+            _POW_WORKERS,
+            _POW_BLOCKS_PER_WORKER,
+        )
+        for worker in range(_POW_WORKERS)
+    ]
+
+
+async def _solve_pow_parallel(challenge: str, difficulty: int) -> Tuple[int, str]:
+    """Solve the proof-of-work on all PoW worker processes without blocking the loop.
+
+    The search stops at the end of the first round that holds a solution. If a
+    worker died (OOM kill, signal), the broken pool is replaced and the search
+    is retried once.
+    """
+    pool = _get_pow_pool()
+    try:
+        return await _search_pow_rounds(pool, challenge, difficulty)
+    except BrokenProcessPool:
+        _discard_pow_pool(pool)
+        return await _search_pow_rounds(_get_pow_pool(), challenge, difficulty)
+
+
+async def _search_pow_rounds(
+    pool: ProcessPoolExecutor, challenge: str, difficulty: int
+) -> Tuple[int, str]:
+    """Run parallel PoW search rounds on `pool` until one holds a solution."""
+    round_size = _POW_WORKERS * _POW_BLOCKS_PER_WORKER
+    for round_start in itertools.count(0, round_size):
+        futures = _submit_pow_round(pool, challenge, difficulty, round_start)
+        solutions = await asyncio.gather(*map(asyncio.wrap_future, futures))
+        solutions = [solution for solution in solutions if solution is not None]
+        if solutions:
+            return min(solutions)
+
+
+def _cached_pow(challenge: str, difficulty: int) -> Optional[Tuple[int, str]]:
+    """Return the cached solution for a challenge, or None if not solved yet."""
+    solution = _POW_SOLUTIONS.get((challenge, difficulty))
+    if solution is not None:
+        _POW_SOLUTIONS.move_to_end((challenge, difficulty))
+    return solution
+
+
+def _store_pow(challenge: str, difficulty: int, solution: Tuple[int, str]) -> None:
+    """Cache a solution, evicting the least recently used ones beyond the limit."""
+    _POW_SOLUTIONS[(challenge, difficulty)] = solution
+    _POW_SOLUTIONS.move_to_end((challenge, difficulty))
+    while len(_POW_SOLUTIONS) > _POW_CACHE_SIZE:
+        _POW_SOLUTIONS.popitem(last=False)
+
+
+def _get_pow_pool() -> ProcessPoolExecutor:
+    """Return the PoW worker pool, creating it on first use.
+
+    Workers are not forked from the server process: it runs threads, and a
+    forked child could inherit a lock held by one of them.
+    """
+    global _POW_PROCESS_POOL
+    if _POW_PROCESS_POOL is None:
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context("forkserver")
+        else:
+            context = multiprocessing.get_context("spawn")
+        _POW_PROCESS_POOL = ProcessPoolExecutor(
+            max_workers=_POW_WORKERS, mp_context=context
+        )
+    return _POW_PROCESS_POOL
+
+
+def _discard_pow_pool(pool: ProcessPoolExecutor) -> None:
+    """Drop a broken PoW worker pool so that the next search starts a new one."""
+    global _POW_PROCESS_POOL
+    # Another search may already have replaced it
+    if _POW_PROCESS_POOL is pool:
+        _POW_PROCESS_POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def anubis_cookies(url: str) -> Dict[str, str]:
+    """Return the Anubis auth cookies stored for the host of `url`."""
+    host = urlparse(url).netloc
+    cookies = _AUTH_COOKIES.get(host)
+    if cookies is None:
+        return {}
+    _AUTH_COOKIES.move_to_end(host)
+    return cookies
+
+
+def _store_auth_cookies(url: str, cookies: Dict[str, str]) -> None:
+    """Remember auth cookies for the host of `url`, evicting the oldest hosts."""
+    host = urlparse(url).netloc
+    _AUTH_COOKIES[host] = {**_AUTH_COOKIES.get(host, {}), **cookies}
+    _AUTH_COOKIES.move_to_end(host)
+    while len(_AUTH_COOKIES) > _AUTH_COOKIES_SIZE:
+        _AUTH_COOKIES.popitem(last=False)
+
+
+def _verification_url(url: str, nonce: int, full_hash: str) -> str:
+    """Build the Anubis pass-challenge URL submitting a solution for `url`."""
+    parsed_url = urlparse(url)
+    base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    pass_challenge_url = (
+        f"{base_url}/.within.website/x/cmd/anubis/api/pass-challenge"
     )
+    params = {
+        "response": full_hash,
+        "nonce": str(nonce),
+        "redir": parsed_url.path or "/",
+        "elapsedTime": "100",
+    }
+    return f"{pass_challenge_url}?{urllib.parse.urlencode(params)}"
+
+
+def extract_challenge_from_html(
+    html: Union[str, bytes],
+) -> Tuple[Optional[str], Optional[int]]:
+    """Extract challenge data from Anubis HTML, given as text or raw bytes.
+
+    Returns (challenge, difficulty) if found, otherwise (None, None).
+    """
+    challenge_re = _CHALLENGE_RE_BYTES if isinstance(html, bytes) else _CHALLENGE_RE
+    script_match = challenge_re.search(html)
     if script_match:
         try:
             challenge_data = json.loads(script_match.group(1))
@@ -63,80 +278,79 @@ def extract_challenge_from_html(html: str) -> Tuple[Optional[str], Optional[int]
     return None, None
 
 
-def solve_anubis_challenge_sync(
+async def solve_anubis_challenge(
+    session: aiohttp.ClientSession,
     url: str,
+    html: Union[str, bytes],
     *,
     user_agent: str,
     request_timeout: int,
 ) -> Optional[str]:
-    """Bypass Anubis protection synchronously using urllib.
+    """Bypass Anubis protection using an existing aiohttp session.
+
+    The challenge is read from the page the caller already fetched, so only
+    the pass-challenge request (and, if needed, a retry of `url`) goes over
+    the network. The auth cookie lands in the session's cookie jar and is
+    also kept per host for later sessions (see anubis_cookies). The
+    proof-of-work runs on worker processes so it neither blocks the event
+    loop nor competes with it for the GIL.
 
     Args:
+        session: aiohttp session used for the requests.
         url: Target URL.
+        html: Anubis challenge page already fetched from `url`.
         user_agent: HTTP User-Agent header to use.
         request_timeout: Timeout in seconds for HTTP requests.
 
     Returns:
-        HTML content after bypassing Anubis protection, or None if failed
-        or if the page is not Anubis-protected.
+        HTML content after bypassing Anubis protection, or None if failed.
     """
-    try:
-        # Create a cookie jar to handle cookies automatically
-        cookie_jar = CookieJar()
-        opener = urllib.request.build_opener(
-            urllib.request.HTTPCookieProcessor(cookie_jar)
-        )
+    headers = {"User-Agent": user_agent}
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
 
-        # First request to get the challenge
-        req = urllib.request.Request(url, headers={"User-Agent": user_agent})
-        with opener.open(req, timeout=request_timeout) as response:
-            html = response.read().decode("utf-8", errors="replace")
-
-            # Not an Anubis page
-            if not is_anubis_page(html):
-                return None
-
-            challenge, difficulty = extract_challenge_from_html(html)
+    async def fetch(target: str) -> bytes:
+        async with session.get(
+            target, headers=headers, timeout=timeout, raise_for_status=True
+        ) as response:
+            return await response.read()
 
+    try:
+        challenge, difficulty = extract_challenge_from_html(html)
         if not challenge or not difficulty:
             return None
 
-        # Solve the proof-of-work
-        nonce, full_hash = solve_anubis_pow(challenge, difficulty)
+        # Solve the proof-of-work off the event loop (challenges are often
+        # reissued, so reuse earlier solutions)
+        solution = _cached_pow(challenge, difficulty)
+        if solution is None:
+            solution = await _solve_pow_parallel(challenge, difficulty)
+            _store_pow(challenge, difficulty, solution)
+        nonce, full_hash = solution
 
-        # Submit solution to get auth cookie
-        parsed_url = urlparse(url)
-        base_url = f"{parsed_url.scheme}://{parsed_url.netloc}"
-        pass_challenge_url = (
-            f"{base_url}/.within.website/x/cmd/anubis/api/pass-challenge"
-        )
-        params = {
-            "response": full_hash,
-            "nonce": str(nonce),
-            "redir": parsed_url.path or "/",
-            "elapsedTime": "100",
-        }
-
-        verification_url = f"{pass_challenge_url}?{urllib.parse.urlencode(params)}"
-        verify_req = urllib.request.Request(
-            verification_url, headers={"User-Agent": user_agent}
-        )
+        # Submit the solution to get the auth cookie and the result
+        async with session.get(
+            _verification_url(url, nonce, full_hash),
+            headers=headers,
+            timeout=timeout,
+            raise_for_status=True,
+        ) as response:
+            content = await response.read()
+            # Remember the cookies set by the pass-challenge response (usually
+            # the redirect back to the page), not those of the page itself
+            cookies = {
+                name: morsel.value
+                for hop in response.history or (response,)
+                for name, morsel in hop.cookies.items()
+            }
+        if cookies:
+            _store_auth_cookies(url, cookies)
 
-        # Submit the solution and get the result
-        with opener.open(verify_req, timeout=request_timeout) as verify_response:
-            verify_content = verify_response.read().decode("utf-8", errors="replace")
-
-            # If still getting Anubis, try original URL with cookies
-            if is_anubis_page(verify_content):
-                final_req = urllib.request.Request(
-                    url, headers={"User-Agent": user_agent}
-                )
-                with opener.open(final_req, timeout=request_timeout) as final_response:
-                    content = final_response.read().decode("utf-8", errors="replace")
-                    if is_anubis_page(content):
-                        return None
-                    return content
-            return verify_content
+        # If still getting Anubis, try original URL with cookies
+        if is_anubis_page(content):
+            content = await fetch(url)
+            if is_anubis_page(content):
+                return None
+        return content.decode("utf-8", errors="replace")
 
     except Exception:
         return None
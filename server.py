@@ -1,18 +1,25 @@
 import os
 import sys
 import base64
+import codecs
+import heapq
+import json
+import struct
+import time
 import aiohttp
 import mcp
 import asyncio
+from collections import OrderedDict
 from urllib.parse import urljoin
-from bs4 import BeautifulSoup
-from typing import List, Dict, Optional, Tuple
+from yarl import URL
+import lxml.html
+from functools import lru_cache
+from lxml import etree
+from lxml.cssselect import CSSSelector
+from typing import List, Dict, Mapping, Optional, Tuple
 import mcp.types as types
 from fastmcp import FastMCP
-from fastmcp.utilities.types import Image
-from PIL import Image
-from io import BytesIO
-from anubis_solver import solve_anubis_challenge_sync, is_anubis_page
+from anubis_solver import anubis_cookies, solve_anubis_challenge, is_anubis_page
 
 HOST = os.environ.get("HOST", "127.0.0.1")
 PORT = int(os.environ.get("PORT", 8000))
@@ -20,11 +27,159 @@ PORT = int(os.environ.get("PORT", 8000))
 LOG_LEVEL: str = "info"
 USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 REQUEST_TIMEOUT: int = 30
+IMAGE_REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=10)
 MAX_RETRIES: int = 3
+IMAGE_FETCH_CONCURRENCY: int = 8
+IMAGE_PROBE_RANGE: int = 8192
+IMAGE_PROBE_CHUNK_SIZE: int = 4096
+IMAGE_PROBE_LIMIT: int = 64 * 1024
+MIN_IMAGE_BYTES: int = 1024
+MAX_IMAGE_BYTES: int = 10 * 1024 * 1024
+PAGE_CHUNK_SIZE: int = 32 * 1024
+MAX_PAGE_BYTES: int = 8 * 1024 * 1024
+# Signatures of the formats parse_image_header reads (WebP is checked separately)
+IMAGE_HEADER_SIGNATURES: Tuple[bytes, ...] = (b"\x89PNG", b"GIF8", b"\xff\xd8")
+IMAGE_CACHE_BYTES: int = 64 * 1024 * 1024
+IMAGE_CACHE_TTL: int = 600
+
+# Text nodes a reader sees: comments are not text nodes, and the contents
+# of scripts, styles and templates are skipped
+_VISIBLE_TEXT = etree.XPath(".//text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+
+# Use pybase64's SIMD encoder for image payloads when available
+try:
+    from pybase64 import b64encode_as_string
+except ImportError:
+    def b64encode_as_string(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
 
 # Create an MCP server with environment variable configuration
 mcp = FastMCP("browser", stateless_http=True)
 
+# Recently downloaded images by URL, least recently used first:
+# (expiry time, data, content type, (width, height))
+_IMAGE_CACHE: "OrderedDict[str, Tuple[float, bytes, str, Tuple[int, int]]]" = OrderedDict()
+_image_cache_bytes: int = 0
+
+# Shared connection pool, created lazily on the server's event loop so that
+# connections (and their TLS handshakes) are reused across tool calls
+_CONNECTOR: Optional[aiohttp.TCPConnector] = None
+
+
+def _get_connector() -> aiohttp.TCPConnector:
+    """
+    Return the shared connection pool, creating it on first use.
+
+    Returns:
+        aiohttp.TCPConnector: Keep-alive connection pool shared by all tool calls
+    """
+    global _CONNECTOR
+    if _CONNECTOR is None or _CONNECTOR.closed:
+        # Per-host limit matches the image fetch concurrency
+        _CONNECTOR = aiohttp.TCPConnector(
+            limit=100,
+            limit_per_host=IMAGE_FETCH_CONCURRENCY,
+            ttl_dns_cache=300,
+            keepalive_timeout=30,
+            enable_cleanup_closed=True,
+        )
+    return _CONNECTOR
+
+
+def _open_session(url: str) -> aiohttp.ClientSession:
+    """
+    Open a session for one tool call on the shared connection pool.
+
+    Each call gets its own cookie jar, so cookies a site sets are kept for
+    the call (redirects, images) but never reach other calls or clients.
+    The jar starts with the Anubis auth cookies of an earlier bypass of the
+    same host.
+
+    Args:
+        url: URL of the page the call browses
+
+    Returns:
+        aiohttp.ClientSession: Session to close at the end of the call (the pool stays open)
+    """
+    # Accept cookies from IP-addressed hosts too: Anubis bypass relies on them
+    cookie_jar = aiohttp.CookieJar(unsafe=True)
+    cookie_jar.update_cookies(anubis_cookies(url), response_url=URL(url))
+    return aiohttp.ClientSession(
+        connector=_get_connector(),
+        connector_owner=False,
+        cookie_jar=cookie_jar,
+        timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+    )
+
+
+async def _close_connector() -> None:
+    """Close the shared connection pool if it has been opened."""
+    global _CONNECTOR
+    if _CONNECTOR is not None:
+        await _CONNECTOR.close()
+        _CONNECTOR = None
+
+
+def parse_image_header(image_data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Read image dimensions straight from the header of common formats.
+
+    Supports PNG, GIF, JPEG and WebP without decoding the image.
+
+    Args:
+        image_data: Raw image bytes (the beginning of the file is enough)
+
+    Returns:
+        Optional[Tuple[int, int]]: (width, height), or None if the format is not recognized
+    """
+    try:
+        # PNG: width and height are the first fields of the IHDR chunk
+        if image_data.startswith(b"\x89PNG\r\n\x1a\n") and image_data[12:16] == b"IHDR":
+            return struct.unpack_from(">II", image_data, 16)
+
+        # GIF: logical screen size follows the signature, little-endian
+        if image_data[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack_from("<HH", image_data, 6)
+
+        # JPEG: walk the segments up to the first start-of-frame marker
+        if image_data.startswith(b"\xff\xd8"):
+            offset = 2
+            while offset + 9 <= len(image_data):
+                if image_data[offset] != 0xFF:
+                    return None
+                marker = image_data[offset + 1]
+                if marker == 0xFF:
+                    # Fill byte before a marker
+                    offset += 1
+                    continue
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack_from(">HH", image_data, offset + 5)
+                    return width, height
+                if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                    # Standalone markers carry no length field
+                    offset += 2
+                    continue
+                segment_length = struct.unpack_from(">H", image_data, offset + 2)[0]
+                offset += 2 + segment_length
+            return None
+
+        # WebP: layout depends on the first chunk (lossy, lossless or extended)
+        if image_data[:4] == b"RIFF" and image_data[8:12] == b"WEBP":
+            chunk = image_data[12:16]
+            if chunk == b"VP8 " and image_data[23:26] == b"\x9d\x01\x2a":
+                width, height = struct.unpack_from("<HH", image_data, 26)
+                return width & 0x3FFF, height & 0x3FFF
+            if chunk == b"VP8L" and image_data[20] == 0x2F:
+                bits = int.from_bytes(image_data[21:25], "little")
+                return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+            if chunk == b"VP8X":
+                width = int.from_bytes(image_data[24:27], "little") + 1
+                height = int.from_bytes(image_data[27:30], "little") + 1
+                return width, height
+    except (struct.error, IndexError):
+        pass
+    return None
+
 
 def get_image_dimensions(image_data: bytes) -> Tuple[int, int]:
     """
@@ -36,83 +191,326 @@ def get_image_dimensions(image_data: bytes) -> Tuple[int, int]:
     Returns:
         Tuple[int, int]: (width, height) or (0, 0) if unable to determine
     """
+    # Fast path: read the size from the header without a full PIL parse
+    dimensions = parse_image_header(image_data)
+    if dimensions is not None:
+        return dimensions
+
+    # PIL cannot do better on the formats parse_image_header knows (the data is
+    # just truncated or broken), so only hand it other formats
+    if image_data.startswith(IMAGE_HEADER_SIGNATURES) or image_data[8:12] == b"WEBP":
+        return (0, 0)
+
+    # Imported on first use: PIL is only needed for uncommon formats
+    from PIL import Image
+    from io import BytesIO
+
     try:
         with Image.open(BytesIO(image_data)) as img:
             return img.size  # Returns (width, height)
     except Exception:
         return (0, 0)
 
-async def fetch_images_from_soup(session: aiohttp.ClientSession, soup: BeautifulSoup, base_url: str, max_images: int = 5) -> List[types.ImageContent]:
+def _get_cached_image(img_url: str) -> Optional[Tuple[bytes, str, Tuple[int, int]]]:
     """
-    Extract and fetch images from a BeautifulSoup object in their original order.
+    Look up a recently downloaded image.
 
     Args:
-        session: The aiohttp session to use for requests
-        soup: BeautifulSoup object of the parsed HTML
-        base_url: Base URL to resolve relative image URLs
-        max_images: Maximum number of images to fetch
+        img_url: Absolute URL of the image
 
     Returns:
-        List[types.ImageContent]: List of fetched images in their original order
+        Optional[Tuple[bytes, str, Tuple[int, int]]]: (data, content type, (width, height)), or None if not cached or expired
     """
-    images = soup.find_all("img", src=True)
-    headers = {"User-Agent": USER_AGENT}
+    global _image_cache_bytes
+    entry = _IMAGE_CACHE.get(img_url)
+    if entry is None:
+        return None
+    if time.monotonic() >= entry[0]:
+        del _IMAGE_CACHE[img_url]
+        _image_cache_bytes -= len(entry[1])
+        return None
+    _IMAGE_CACHE.move_to_end(img_url)
+    return entry[1:]
+
+
+def _cache_lifetime(headers: Mapping[str, str]) -> int:
+    """
+    Work out how long an image response may be reused from its caching headers.
+
+    Args:
+        headers: Headers of the image response
 
-    # List to store image data with dimensions for sorting
-    image_data_list = []
+    Returns:
+        int: Lifetime in seconds, at most IMAGE_CACHE_TTL, or 0 if the response must not be cached
+    """
+    cache_control = headers.get('cache-control')
+    if cache_control is None:
+        return 0 if 'no-cache' in headers.get('pragma', '').lower() else IMAGE_CACHE_TTL
+
+    directives = {}
+    for directive in cache_control.lower().split(','):
+        name, _, value = directive.partition('=')
+        directives[name.strip()] = value.strip().strip('"')
+
+    # The cache is shared by every client, so private responses are not kept either
+    if directives.keys() & {'no-store', 'no-cache', 'private'}:
+        return 0
+
+    # s-maxage is meant for shared caches and takes precedence over max-age;
+    # an invalid value makes the response stale right away
+    max_age = directives.get('s-maxage', directives.get('max-age'))
+    if max_age is None:
+        return IMAGE_CACHE_TTL
+    return min(int(max_age), IMAGE_CACHE_TTL) if max_age.isdigit() else 0
+
+def _cache_image(img_url: str, img_data: bytes, content_type: str, dimensions: Tuple[int, int], lifetime: int) -> None:
+    """
+    Remember a downloaded image, evicting the least recently used ones to stay within IMAGE_CACHE_BYTES.
 
-    for index, img in enumerate(images):
-        img_src = img.get("src")
-        if not img_src:
-            continue
+    Args:
+        img_url: Absolute URL of the image
+        img_data: Raw image bytes
+        content_type: Content type the image was served with
+        dimensions: (width, height) of the image
+        lifetime: Seconds the image may be reused for (see _cache_lifetime), 0 to not cache it
+    """
+    global _image_cache_bytes
+    if lifetime <= 0 or len(img_data) > IMAGE_CACHE_BYTES:
+        return
 
-        # Convert relative URLs to absolute
-        img_url = urljoin(base_url, img_src)
+    previous = _IMAGE_CACHE.pop(img_url, None)
+    if previous is not None:
+        _image_cache_bytes -= len(previous[1])
 
-        try:
-            # Fetch the image with shorter timeout for individual images
-            async with session.get(img_url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as img_response:
-                if img_response.status == 200:
-                    img_data = await img_response.read()
+    _IMAGE_CACHE[img_url] = (time.monotonic() + lifetime, img_data, content_type, dimensions)
+    _image_cache_bytes += len(img_data)
 
-                    # Get image dimensions
-                    width, height = get_image_dimensions(img_data)
-                    pixel_count = width * height
+    while _image_cache_bytes > IMAGE_CACHE_BYTES:
+        _, (_, evicted_data, _, _) = _IMAGE_CACHE.popitem(last=False)
+        _image_cache_bytes -= len(evicted_data)
+
+def _range_total(content_range: Optional[str]) -> Optional[int]:
+    """
+    Read the full size of a resource from a Content-Range header.
+
+    Args:
+        content_range: Header value such as "bytes 0-8191/123456"
+
+    Returns:
+        Optional[int]: The full size in bytes, or None if the header does not give it
+    """
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1].strip()
+        if total.isdigit():
+            return int(total)
+    return None
+
+async def _probe_image(session: aiohttp.ClientSession, img_url: str, index: int, semaphore: asyncio.Semaphore) -> Optional[Dict]:
+    """
+    Fetch the beginning of a single image and collect the information used to rank it.
+
+    Only the first IMAGE_PROBE_RANGE bytes are requested, followed by the rest of
+    the first IMAGE_PROBE_LIMIT bytes when they do not give the image size (a JPEG
+    with a large EXIF segment, for instance). When the server ignores the Range
+    header, the body is streamed until the header gives the image size and the
+    rest is left unread. Images smaller than MIN_IMAGE_BYTES (tracking pixels,
+    spacers) are skipped, as are images announced as larger than MAX_IMAGE_BYTES.
+
+    Args:
+        session: The aiohttp session to use for requests
+        img_url: Absolute URL of the image
+        index: Position of the image in the page, used to restore page order
+        semaphore: Semaphore bounding the number of concurrent image fetches
+
+    Returns:
+        Optional[Dict]: Image information with its dimensions, or None if the image could not be fetched or was skipped.
+        'data' holds the whole image when it was cached or fully read, and is None otherwise
+    """
+    # Reuse a recent download of the same image
+    cached = _get_cached_image(img_url)
+    if cached is not None:
+        img_data, content_type, (width, height) = cached
+    else:
+        header = bytearray()
+        width = height = 0
+        complete = False
+        range_end = IMAGE_PROBE_RANGE
+
+        async with semaphore:
+            while True:
+                # Ask for the raw bytes: a range of a compressed body cannot be decoded
+                # on its own, and images gain nothing from compression anyway
+                headers = {"User-Agent": USER_AGENT, "Range": f"bytes={len(header)}-{range_end - 1}", "Accept-Encoding": "identity"}
+
+                # Fetch the image with shorter timeout for individual images
+                async with session.get(img_url, headers=headers, timeout=IMAGE_REQUEST_TIMEOUT) as img_response:
+                    if img_response.status == 206:
+                        total_size = _range_total(img_response.headers.get('content-range'))
+                    elif img_response.status == 200 and not header:
+                        total_size = img_response.content_length
+                    elif header:
+                        # The follow-up range was refused, keep what we have
+                        break
+                    else:
+                        return None
+
+                    # Skip tracking pixels and spacers without reading their body,
+                    # and images too large to be downloaded whole
+                    if total_size is not None and not MIN_IMAGE_BYTES <= total_size <= MAX_IMAGE_BYTES:
+                        return None
 
                     # Get content type, default to jpeg if not specified
                     content_type = img_response.headers.get('content-type', 'image/jpeg')
+                    lifetime = _cache_lifetime(img_response.headers)
+
+                    # Read the start of the body until the header gives the image size
+                    # (PIL only reads headers too, so it also works on the partial body
+                    # for formats parse_image_header does not know)
+                    async for chunk in img_response.content.iter_chunked(IMAGE_PROBE_CHUNK_SIZE):
+                        header += chunk
+                        width, height = get_image_dimensions(bytes(header))
+                        if (width and height) or len(header) >= IMAGE_PROBE_LIMIT:
+                            break
+
+                    # Small images may already have been read whole
+                    if img_response.status == 200:
+                        complete = img_response.content.at_eof()
+                        break
+                    complete = total_size is not None and len(header) >= total_size
+
+                if complete or (width and height) or range_end >= IMAGE_PROBE_LIMIT:
+                    break
+                range_end = IMAGE_PROBE_LIMIT
+
+        img_data = bytes(header) if complete else None
+        if img_data is not None:
+            _cache_image(img_url, img_data, content_type, (width, height), lifetime)
+
+    return {
+        'data': img_data,
+        'content_type': content_type,
+        'width': width,
+        'height': height,
+        'pixel_count': width * height,
+        'url': img_url,
+        'original_index': index  # Keep track of original order
+    }
+
+async def _download_image(session: aiohttp.ClientSession, img_url: str, semaphore: asyncio.Semaphore) -> Optional[Tuple[bytes, int]]:
+    """
+    Fetch the full body of a single image.
+
+    Args:
+        session: The aiohttp session to use for requests
+        img_url: Absolute URL of the image
+        semaphore: Semaphore bounding the number of concurrent image fetches
+
+    Returns:
+        Optional[Tuple[bytes, int]]: The image data and its cache lifetime in seconds, or None if the image could not be fetched or is larger than MAX_IMAGE_BYTES
+    """
+    headers = {"User-Agent": USER_AGENT}
+
+    async with semaphore:
+        async with session.get(img_url, headers=headers, timeout=IMAGE_REQUEST_TIMEOUT) as img_response:
+            if img_response.status != 200:
+                return None
+
+            # Stop reading if the body outgrows MAX_IMAGE_BYTES (the probe only
+            # rules out images that announce a larger size)
+            img_data = bytearray()
+            async for chunk in img_response.content.iter_chunked(PAGE_CHUNK_SIZE):
+                img_data += chunk
+                if len(img_data) > MAX_IMAGE_BYTES:
+                    return None
+            return bytes(img_data), _cache_lifetime(img_response.headers)
+
+async def _complete_images(session: aiohttp.ClientSession, images: List[Dict], semaphore: asyncio.Semaphore) -> None:
+    """
+    Download the full body of probed images, filling in their 'data'.
+
+    Images whose size the probe could not read get it from the full body.
+    Images that fail to download keep 'data' set to None.
 
-                    # Store image info for sorting, including original index
-                    image_info = {
-                        'data': img_data,
-                        'content_type': content_type,
-                        'width': width,
-                        'height': height,
-                        'pixel_count': pixel_count,
-                        'url': img_url,
-                        'original_index': index  # Keep track of original order
-                    }
-                    image_data_list.append(image_info)
-
-        except Exception as e:
-            # If individual image fails, continue with others
+    Args:
+        session: The aiohttp session to use for requests
+        images: Image information from _probe_image with 'data' set to None
+        semaphore: Semaphore bounding the number of concurrent image fetches
+    """
+    downloads = await asyncio.gather(
+        *(_download_image(session, img_info['url'], semaphore) for img_info in images),
+        return_exceptions=True,
+    )
+    for img_info, download in zip(images, downloads):
+        if not isinstance(download, tuple):
             continue
+        img_data, lifetime = download
+        img_info['data'] = img_data
+        if not img_info['pixel_count']:
+            img_info['width'], img_info['height'] = get_image_dimensions(img_data)
+            img_info['pixel_count'] = img_info['width'] * img_info['height']
+        _cache_image(img_info['url'], img_data, img_info['content_type'], (img_info['width'], img_info['height']), lifetime)
+
+async def fetch_images_from_tree(session: aiohttp.ClientSession, tree: lxml.html.HtmlElement, base_url: str, max_images: int = 5) -> List[types.ImageContent]:
+    """
+    Extract and fetch images from a parsed page in their original order.
 
-    # Sort images by pixel count (largest first) to select the biggest ones
-    image_data_list.sort(key=lambda x: x['pixel_count'], reverse=True)
+    Args:
+        session: The aiohttp session to use for requests
+        tree: Root element of the parsed HTML
+        base_url: Base URL to resolve relative image URLs
+        max_images: Maximum number of images to fetch
 
-    # Take the max_images biggest images
-    biggest_images = image_data_list[:max_images]
+    Returns:
+        List[types.ImageContent]: List of fetched images in their original order
+    """
+    if max_images <= 0:
+        return []
+
+    # Convert relative URLs to absolute, fetching each distinct image once
+    # (dict keys keep the page order of first appearance)
+    img_urls = list(dict.fromkeys(urljoin(base_url, src) for src in tree.xpath("//img/@src") if src))
+
+    # Probe all images concurrently, bounded so we don't hammer the origin
+    semaphore = asyncio.Semaphore(IMAGE_FETCH_CONCURRENCY)
+    results = await asyncio.gather(
+        *(_probe_image(session, img_url, index, semaphore) for index, img_url in enumerate(img_urls)),
+        return_exceptions=True,
+    )
+
+    # Keep the images that were probed; failed ones are simply skipped
+    image_data_list = [image_info for image_info in results if isinstance(image_info, dict)]
+
+    # Images the probe could not size are downloaded whole so they can be ranked
+    await _complete_images(
+        session,
+        [img_info for img_info in image_data_list if not img_info['pixel_count'] and img_info['data'] is None],
+        semaphore,
+    )
+
+    # Rank the images by pixel count, largest first (page order on ties)
+    ranking = [(-img_info['pixel_count'], position) for position, img_info in enumerate(image_data_list)]
+    heapq.heapify(ranking)
+
+    # Take the max_images biggest images, downloading the full body of those
+    # that were only probed and moving on to the next largest when one fails
+    biggest_images = []
+    while ranking and len(biggest_images) < max_images:
+        batch = [image_data_list[heapq.heappop(ranking)[1]] for _ in range(min(max_images - len(biggest_images), len(ranking)))]
+        await _complete_images(session, [img_info for img_info in batch if img_info['data'] is None], semaphore)
+        biggest_images.extend(img_info for img_info in batch if img_info['data'] is not None)
 
     # Re-sort the selected biggest images by their original order
     biggest_images.sort(key=lambda x: x['original_index'])
 
+    # Encode all selected images in one worker thread, off the event loop
+    encoded_images = await asyncio.to_thread(lambda: [b64encode_as_string(img_info['data']) for img_info in biggest_images])
+
     # Convert to ImageContent objects
     image_content_list = []
-    for img_info in biggest_images:
+    for img_info, encoded_data in zip(biggest_images, encoded_images):
         image_content = types.ImageContent(
             type="image",
-            data=base64.b64encode(img_info['data']).decode('utf-8'),
+            data=encoded_data,
             mimeType=img_info['content_type']
         )
         image_content_list.append(image_content)
@@ -121,6 +519,138 @@ async def fetch_images_from_soup(session: aiohttp.ClientSession, soup: Beautiful
 
 
 
+def decode_html(content: bytes, charset: Optional[str] = None) -> str:
+    """
+    Decode a page body, normally with a single decode call.
+
+    Args:
+        content: Raw response body
+        charset: Charset declared in the Content-Type header, if any
+
+    Returns:
+        str: The decoded HTML. Undecodable bytes are replaced rather than raising
+    """
+    # Trust the charset declared by the server when it is one we know
+    if charset:
+        try:
+            return content.decode(charset, errors='replace')
+        except LookupError:
+            pass
+
+    # Otherwise assume UTF-8, and fall back to Windows-1252 (a superset of
+    # ISO-8859-1) for legacy pages that are not valid UTF-8
+    try:
+        return content.decode('utf-8')
+    except UnicodeDecodeError:
+        return content.decode('windows-1252', errors='replace')
+
+
+def parse_html(html: str) -> lxml.html.HtmlElement:
+    """
+    Parse a page into an lxml tree.
+
+    Args:
+        html: The decoded HTML
+
+    Returns:
+        lxml.html.HtmlElement: Root <html> element (empty for an empty page)
+    """
+    # Feeding the parser, unlike lxml.html.fromstring, accepts text that still
+    # carries an XML encoding declaration
+    parser = lxml.html.HTMLParser()
+    parser.feed(html)
+    root = parser.close()
+    return root if root is not None else lxml.html.Element("html")
+
+
+async def read_page(response: aiohttp.ClientResponse) -> Tuple[bytes, lxml.html.HtmlElement]:
+    """
+    Read a page body into an lxml tree, parsing chunks as they arrive.
+
+    Decoding follows decode_html: the declared charset when known, otherwise
+    UTF-8, with the whole body decoded again by decode_html if it turns out not
+    to be UTF-8. Reading stops after MAX_PAGE_BYTES.
+
+    Args:
+        response: Response of the page request, body not read yet
+
+    Returns:
+        Tuple[bytes, lxml.html.HtmlElement]: The raw (possibly truncated) body and the root element of the parsed page
+    """
+    decoder = None
+    if response.charset:
+        try:
+            decoder = codecs.getincrementaldecoder(response.charset)(errors='replace')
+        except LookupError:
+            pass
+    if decoder is None:
+        decoder = codecs.getincrementaldecoder('utf-8')()
+
+    parser = lxml.html.HTMLParser()
+    body = bytearray()
+    truncated = False
+    async for chunk in response.content.iter_chunked(PAGE_CHUNK_SIZE):
+        if len(body) + len(chunk) >= MAX_PAGE_BYTES:
+            chunk = chunk[:MAX_PAGE_BYTES - len(body)]
+            truncated = True
+        body += chunk
+        if parser is not None:
+            try:
+                parser.feed(decoder.decode(chunk))
+            except UnicodeDecodeError:
+                # Not UTF-8 after all: decode the whole body once it is read
+                parser = None
+        if truncated:
+            break
+
+    body = bytes(body)
+    if parser is None:
+        return body, parse_html(decode_html(body, response.charset))
+
+    # A truncated body may end in the middle of a character, drop it
+    if not truncated:
+        try:
+            parser.feed(decoder.decode(b"", final=True))
+        except UnicodeDecodeError:
+            return body, parse_html(decode_html(body, response.charset))
+    root = parser.close()
+    return body, root if root is not None else lxml.html.Element("html")
+
+
+@lru_cache(maxsize=128)
+def _css_selector(selector: str) -> CSSSelector:
+    """Compile a CSS selector to XPath once per selector string."""
+    return CSSSelector(selector, translator="html")
+
+
+def _stripped_text(element: lxml.html.HtmlElement) -> str:
+    """Join the visible text of an element, one space between stripped strings."""
+    return " ".join(filter(None, map(str.strip, _VISIBLE_TEXT(element))))
+
+
+def extract_page_content(tree: lxml.html.HtmlElement) -> Dict:
+    """
+    Extract the title, text and links of a page.
+
+    Args:
+        tree: Root element of the parsed HTML
+
+    Returns:
+        Dict: The page "title", its "text" (stripped strings joined by spaces) and its "links" (text and href of each anchor)
+    """
+    title = tree.find(".//title")
+
+    return {
+        "title": title.text if title is not None else None,
+        # Words from adjacent elements stay separated instead of running together
+        "text": _stripped_text(tree),
+        "links": [
+            {"text": "".join(_VISIBLE_TEXT(link)).strip(), "href": link.get("href")}
+            for link in tree.iterfind(".//a[@href]")
+        ],
+    }
+
+
 @mcp.tool()
 async def browse_webpage(url: str, selectors: dict = None, capture_images: bool = True, max_images: int = 5) -> List[types.Content]:
     """
@@ -138,114 +668,111 @@ async def browse_webpage(url: str, selectors: dict = None, capture_images: bool
     if selectors is None:
         selectors = {}
 
-    async with aiohttp.ClientSession() as session:
-        try:
-            headers = {"User-Agent": USER_AGENT}
-            timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    session = _open_session(url)
 
-            # Fetch the main page
-            async with session.get(url, headers=headers, timeout=timeout) as response:
-                if response.status >= 400:
-                    return [
-                        types.TextContent(
-                            type="text",
-                            text=f"Error: HTTP {response.status} - Failed to fetch webpage",
-                        )
-                    ]
-                # NOUVELLE LOGIQUE: Vérifier le Content-Type pour détecter les images directes
-                content_type = response.headers.get('content-type', '').lower()
-
-                # Si c'est une image directe, la traiter comme telle
-                if content_type.startswith('image/'):
-                    if capture_images:
-                        img_data = await response.read()
-                        width, height = get_image_dimensions(img_data)
-
-                        image_content = types.ImageContent(
-                            type="image",
-                            data=base64.b64encode(img_data).decode('utf-8'),
-                            mimeType=content_type
-                        )
-
-                        # Retourner info + image
-                        text_info = f"Direct image: {url}\nDimensions: {width}x{height} pixels\nContent-Type: {content_type}\nSize: {len(img_data)} bytes"
-                        return [
-                            types.TextContent(type="text", text=text_info),
-                            image_content
-                        ]
-
-                # Handle encoding issues
-                try:
-                    html = await response.text()
-                except UnicodeDecodeError:
-                    try:
-                        content = await response.read()
-                        for encoding in ['utf-8', 'iso-8859-1', 'windows-1252', 'cp1252']:
-                            try:
-                                html = content.decode(encoding)
-                                break
-                            except UnicodeDecodeError:
-                                continue
-                        else:
-                            html = content.decode('utf-8', errors='replace')
-                    except Exception:
-                        return [types.TextContent(type="text", text="Error: Could not decode webpage content")]
-
-
-                # Check for Anubis protection and attempt bypass
-                if is_anubis_page(html):
-                    # Use synchronous bypass (since we need urllib for cookie jar)
-                    loop = asyncio.get_event_loop()
-                    bypassed_html = await loop.run_in_executor(
-                    None,
-                    lambda: solve_anubis_challenge_sync(
-                        url, user_agent=USER_AGENT, request_timeout=REQUEST_TIMEOUT
+    try:
+        headers = {"User-Agent": USER_AGENT}
+
+        # Fetch the main page
+        async with session.get(url, headers=headers) as response:
+            if response.status >= 400:
+                return [
+                    types.TextContent(
+                        type="text",
+                        text=f"Error: HTTP {response.status} - Failed to fetch webpage",
                     )
-                )
+                ]
+            # NOUVELLE LOGIQUE: Vérifier le Content-Type pour détecter les images directes
+            content_type = response.headers.get('content-type', '').lower()
 
-                    if bypassed_html:
-                        html = bypassed_html
-                    else:
-                        return [types.TextContent(type="text", text="Error: Failed to bypass Anubis protection")]
-
-                soup = BeautifulSoup(html, "html.parser")
-
-                # Extract basic page information
-                result = {
-                    "title": soup.title.string if soup.title else None,
-                    "text": soup.get_text(strip=True),
-                    "links": [
-                        {"text": link.text.strip(), "href": link.get("href")}
-                        for link in soup.find_all("a", href=True)
-                    ],
-                }
-
-                # Extract content using provided selectors
-                if selectors:
-                    for key, selector in selectors.items():
-                        elements = soup.select(selector)
-                        result[key] = [elem.get_text(strip=True) for elem in elements]
-
-                # Start with text content
-                content_list = [types.TextContent(type="text", text=str(result))]
-
-                # Fetch images if requested (now sorted by size)
+            # Si c'est une image directe, la traiter comme telle
+            if content_type.startswith('image/'):
                 if capture_images:
-                    image_contents = await fetch_images_from_soup(session, soup, url, max_images)
-                    content_list.extend(image_contents)
+                    too_large = [types.TextContent(type="text", text=f"Error: Image larger than {MAX_IMAGE_BYTES} bytes")]
+
+                    # Refuse oversized images up front, and stop reading if the
+                    # body outgrows a missing or wrong Content-Length
+                    if response.content_length is not None and response.content_length > MAX_IMAGE_BYTES:
+                        return too_large
+                    img_data = bytearray()
+                    async for chunk in response.content.iter_chunked(PAGE_CHUNK_SIZE):
+                        img_data += chunk
+                        if len(img_data) > MAX_IMAGE_BYTES:
+                            return too_large
+                    img_data = bytes(img_data)
+
+                    # Header parse; PIL is only used for uncommon formats
+                    width, height = get_image_dimensions(img_data)
+
+                    image_content = types.ImageContent(
+                        type="image",
+                        data=b64encode_as_string(img_data),
+                        mimeType=content_type
+                    )
 
-                return content_list
+                    # Retourner info + image
+                    text_info = f"Direct image: {url}\nDimensions: {width}x{height} pixels\nContent-Type: {content_type}\nSize: {len(img_data)} bytes"
+                    return [
+                        types.TextContent(type="text", text=text_info),
+                        image_content
+                    ]
 
-        except asyncio.TimeoutError:
-            return [
-                types.TextContent(
-                    type="text", text="Error: Request timed out while fetching webpage"
+            # Parse the body while it downloads
+            content, tree = await read_page(response)
+
+            # Check for Anubis protection and attempt bypass
+            if is_anubis_page(content):
+                # Bypass on this call's session, reusing the challenge page we
+                # already have (the auth cookie is kept for later calls)
+                bypassed_html = await solve_anubis_challenge(
+                    session, url, content, user_agent=USER_AGENT, request_timeout=REQUEST_TIMEOUT
                 )
-            ]
-        except aiohttp.ClientError as e:
-            return [types.TextContent(type="text", text=f"Error: {str(e)}")]
-        except Exception as e:
-            return [types.TextContent(type="text", text=f"Error: {str(e)}")]
+
+                if bypassed_html:
+                    tree = parse_html(bypassed_html)
+                else:
+                    return [types.TextContent(type="text", text="Error: Failed to bypass Anubis protection")]
+
+            # Extract basic page information
+            result = extract_page_content(tree)
+
+            # Extract content using provided selectors
+            if selectors:
+                for key, selector in selectors.items():
+                    elements = _css_selector(selector)(tree)
+                    result[key] = [_stripped_text(elem) for elem in elements]
+
+            # Start with text content, serialized as compact JSON
+            content_list = [types.TextContent(type="text", text=json.dumps(result, ensure_ascii=False, separators=(",", ":")))]
+
+            # Fetch images if requested (now sorted by size)
+            if capture_images:
+                image_contents = await fetch_images_from_tree(session, tree, url, max_images)
+                content_list.extend(image_contents)
+
+            return content_list
+
+    except asyncio.TimeoutError:
+        return [
+            types.TextContent(
+                type="text", text="Error: Request timed out while fetching webpage"
+            )
+        ]
+    except aiohttp.ClientError as e:
+        return [types.TextContent(type="text", text=f"Error: {str(e)}")]
+    except Exception as e:
+        return [types.TextContent(type="text", text=f"Error: {str(e)}")]
+    finally:
+        await session.close()
+
+
+async def main() -> None:
+    """Serve the MCP server over HTTP, closing the shared connection pool on exit."""
+    try:
+        await mcp.run_async(transport="http", host=HOST, port=PORT, path="/browser")
+    finally:
+        await _close_connector()
+
 
 if __name__ == "__main__":
     try:
@@ -253,7 +780,7 @@ if __name__ == "__main__":
         print(f"Log level is {LOG_LEVEL}")
 
         print(f"Starting MCP server on {HOST}:{PORT}")
-        mcp.run(transport="http", host=HOST, port=PORT, path="/browser")
+        asyncio.run(main())
     except KeyboardInterrupt:
         print("\nShutting down MCP server...")
         print("system", "shutdown", True)